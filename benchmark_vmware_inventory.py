@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+''' Time fetched property conversion, fact normalization and pattern
+rendering across worker processes '''
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import multiprocessing
+import uuid
+
+from pyVmomi import vim
+from time import time
+
+from vmware_inventory import VMWareInventory
+
+
+def synthetic_vm(i):
+
+    ''' Build the property set of one VM out of pyvmomi data objects '''
+
+    booted = datetime.datetime(2016, 5, 16, 18, 43, 14)
+    devices = []
+    for d in range(20):
+        backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+            fileName='[ds1] vm%d/disk%d.vmdk' % (i, d), diskMode='persistent')
+        devices.append(vim.vm.device.VirtualDisk(
+            key=2000 + d, unitNumber=d, capacityInKB=16777216, backing=backing,
+            deviceInfo=vim.Description(label='Hard disk %d' % d, summary='16 GB')))
+    hardware = vim.vm.VirtualHardware(numCPU=2, memoryMB=4096, device=devices)
+    config = vim.vm.ConfigInfo(
+        name='vm%05d' % i, uuid=str(uuid.uuid4()), instanceUuid=str(uuid.uuid4()),
+        changeVersion='2016-05-16T18:43:14.977925Z', guestId='rhel7_64Guest',
+        template=(i % 10 == 0), modified=booted, hardware=hardware,
+        extraConfig=[vim.option.OptionValue(key='key%d' % e, value='value%d' % e)
+                     for e in range(30)])
+    nics = [vim.vm.GuestInfo.NicInfo(network='vlan%d' % n,
+                                     ipAddress=['10.0.%d.%d' % (n, i & 255)])
+            for n in range(4)]
+    guest = vim.vm.GuestInfo(
+        guestState='running' if i % 4 else 'notRunning', guestId='rhel7_64Guest',
+        ipAddress='10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), net=nics)
+    runtime = vim.vm.RuntimeInfo(powerState='poweredOn', maxMemoryUsage=4096,
+                                 bootTime=booted, host=vim.HostSystem('host-1'))
+    summary = vim.vm.Summary(quickStats=vim.vm.Summary.QuickStats(
+        overallCpuUsage=100, guestMemoryUsage=1024, uptimeSeconds=3600))
+    return {'name': config.name, 'config': config, 'guest': guest,
+            'runtime': runtime, 'summary': summary,
+            'datastore': [vim.Datastore('datastore-1')],
+            'customValue': [vim.CustomFieldsManager.StringValue(key=101, value='prod')]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--hosts', type=int, default=2000,
+                        help='number of synthetic VMs (default: 2000)')
+    parser.add_argument('--max-object-level', type=int, default=4,
+                        help='max_object_level used for normalization (default: 4)')
+    args = parser.parse_args()
+
+    instances = [vim.VirtualMachine('vm-%d' % i) for i in range(args.hosts)]
+    fetched = dict((x._moId, synthetic_vm(i)) for i, x in enumerate(instances))
+
+    vmw = VMWareInventory(load=False)
+    vmw.args = argparse.Namespace(debug=False)
+    vmw.maxlevel = args.max_object_level
+    vmw.custom_field_map = {101: 'env'}
+    if vmw.maxlevel >= 1:
+        vmw.alias_pattern = '{{ config.name + "_" + config.uuid }}'
+        vmw.host_pattern = '{{ guest.ipaddress }}'
+        vmw.host_filters = ['{{ guest.gueststate == "running" }}']
+        vmw.groupby_patterns = ['{{ guest.guestid }}',
+                                '{{ "templates" if config.template else "guests"}}',
+                                '{{ custom_attributes.env }}']
+    else:
+        # nested facts are dropped at level 0, only top level ones remain
+        vmw.alias_pattern = '{{ name }}'
+        vmw.host_pattern = '{{ name }}'
+        vmw.host_filters = []
+        vmw.groupby_patterns = ['{{ custom_attributes.env }}']
+    # stand in for the PropertyCollector, the fetched objects are prebuilt
+    vmw.content = object()
+    vmw._retrieve_properties = lambda objects, path_set=None: \
+        dict((x._moId, fetched[x._moId]) for x in objects)
+
+    print('%d hosts, max_object_level %d, %d cpu(s)' %
+          (args.hosts, args.max_object_level, multiprocessing.cpu_count()))
+    # one untimed pass so that the first measurement is not a warm up
+    vmw.worker_processes = 1
+    vmw.hosts_to_inventory(vmw._instances_to_hosts(instances))
+
+    baseline = None
+    for workers in [1, 2, 4, 8]:
+        vmw.worker_processes = workers
+        start = time()
+        hosts = vmw._instances_to_hosts(instances)
+        converted = time() - start
+        inventory = vmw.hosts_to_inventory(hosts)
+        elapsed = time() - start
+        baseline = baseline or elapsed
+        print('%d worker(s): %6.2fs  %4.2fx  (%.2fs serial conversion, %d hosts in inventory)' %
+              (workers, elapsed, baseline / elapsed, converted,
+               len(inventory['all']['hosts'])))
+
+
+if __name__ == "__main__":
+    main()
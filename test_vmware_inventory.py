@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
 import json
+import os
 import pickle
+import tempfile
 import unittest
 
+from pyVmomi import vim
+
 from vmware_inventory import VMWareInventory
 
 BASICINVENTORY = {'all': {'hosts': ['foo', 'bar']},
@@ -19,6 +23,44 @@ class FakeArgs(object):
     host = False
     list = True
 
+class FakeObject(object):
+    def __init__(self, **kwargs):
+        for k,v in kwargs.items():
+            setattr(self, k, v)
+
+def live_vm_properties(changeversion):
+    config = vim.vm.ConfigInfo(name='live', instanceUuid='abc',
+                               changeVersion=changeversion)
+    return {'config.instanceUuid': 'abc',
+            'config.changeVersion': changeversion,
+            'config': config,
+            'capability': vim.vm.Capability(snapshotOperationsSupported=True),
+            'guest': vim.vm.GuestInfo(ipAddress='10.0.0.1'),
+            'customValue': [vim.CustomFieldsManager.StringValue(key=101, value='prod')]}
+
+def bulk_inventory(fetched):
+    ''' An inventory whose PropertyCollector returns fetched[moid] '''
+    vmw = VMWareInventory(load=False)
+    vmw.args = FakeArgs()
+    vmw.alias_pattern = '{{ config.name }}'
+    vmw.host_pattern = '{{ guest.ipaddress }}'
+    vmw.host_filters = []
+    vmw.groupby_patterns = []
+    vmw.custom_field_map = {101: 'env'}
+    vmw.content = object()
+    vmw.vm_facts_cache_path = '/dev/null'
+    calls = []
+    def retrieve(objects, paths=None):
+        calls.append(paths)
+        properties = {}
+        for x in objects:
+            props = fetched[x._moId]
+            names = paths or [p for p in props if '.' not in p]
+            properties[x._moId] = dict((p, props[p]) for p in names if p in props)
+        return properties
+    vmw._retrieve_properties = retrieve
+    return vmw, calls
+
 class TestVMWareInventory(unittest.TestCase):
 
     def test_host_info_returns_single_host(self):
@@ -102,6 +144,169 @@ class TestVMWareInventory(unittest.TestCase):
         #import epdb; epdb.st()
         assert showdata == expected
 
+    def test_custom_field_map_resolves_keys_to_names(self):
+        vmw = VMWareInventory(load=False)
+        fields = [FakeObject(key=101, name='owner'),
+                  FakeObject(key=102, name='env')]
+        content = FakeObject(customFieldsManager=FakeObject(field=fields))
+        field_map = vmw._get_custom_field_map(content)
+        assert field_map == {101: 'owner', 102: 'env'}
+
+    def test_custom_attributes_are_flattened_by_name(self):
+        vmw = VMWareInventory(load=False)
+        vmw.custom_field_map = {101: 'owner', 102: 'env'}
+        values = [FakeObject(key=101, value='jdoe'),
+                  FakeObject(key=102, value='prod'),
+                  FakeObject(key=103, value='orphan')]
+        attributes = vmw._get_custom_attributes(values)
+        assert attributes == {'owner': 'jdoe', 'env': 'prod', '103': 'orphan'}
+
+    def test_facts_from_vobj_contains_custom_attributes(self):
+        vmw = VMWareInventory(load=False)
+        vmw.args = FakeArgs()
+        vmw.custom_field_map = {101: 'owner'}
+        vm = FakeObject(customValue=[FakeObject(key=101, value='jdoe')])
+        facts = vmw.facts_from_vobj(vm)
+        assert facts['custom_attributes'] == {'owner': 'jdoe'}
+
+    def test_plain_from_vobj_returns_picklable_data(self):
+        vmw = VMWareInventory(load=False)
+        config = vim.vm.ConfigInfo(name='live', instanceUuid='abc')
+        vm = {'config': config, 'parent': vim.Folder('group-v1'),
+              'customValue': [vim.CustomFieldsManager.StringValue(key=101, value='prod')]}
+        plain = vmw.plain_from_vobj(vm)
+        assert plain['config']['name'] == 'live'
+        assert plain['parent'] is None
+        assert plain['customValue'][0]['value'] == 'prod'
+        assert pickle.loads(pickle.dumps(plain)) == plain
+
+    def test_plain_from_vobj_stops_at_max_object_level(self):
+        vmw = VMWareInventory(load=False)
+        vmw.args = FakeArgs()
+        vmw.maxlevel = 0
+        hardware = vim.vm.VirtualHardware(numCPU=2)
+        vm = {'name': 'live',
+              'config': vim.vm.ConfigInfo(name='live', hardware=hardware)}
+        assert vmw.plain_from_vobj(vm) == {'name': 'live', 'config': None}
+        # customValue is kept whatever the level for custom_attributes
+        vmw.custom_field_map = {101: 'env'}
+        values = [vim.CustomFieldsManager.StringValue(key=101, value='prod')]
+        plain = vmw.plain_from_vobj({'customValue': values})
+        assert vmw.facts_from_vobj(plain)['custom_attributes'] == {'env': 'prod'}
+        vmw.maxlevel = 1
+        plain = vmw.plain_from_vobj(vm)
+        assert plain['config']['name'] == 'live'
+        assert plain['config']['hardware'] is None
+        # the facts match those normalized from the untrimmed objects
+        for maxlevel in [0, 1, 2]:
+            vmw.maxlevel = maxlevel
+            assert vmw.facts_from_vobj(vmw.plain_from_vobj(vm)) == \
+                vmw.facts_from_vobj(dict(vm))
+
+    def test_hosts_to_inventory_matches_across_worker_processes(self):
+        vmw = bulk_inventory({})[0]
+        vmw.host_filters = ['{{ guest.gueststate == "running" }}']
+        vmw.groupby_patterns = ['{{ guest.guestid }}']
+        hosts = []
+        for i in range(5):
+            guest = {'ipAddress': '10.0.0.%d' % i, 'guestId': 'rhel7_64Guest',
+                     'guestState': 'running' if i % 2 else 'notRunning'}
+            hosts.append(('id%d' % i, {'config': {'name': 'vm%d' % i}, 'guest': guest}, {}, None))
+        serial = vmw.hosts_to_inventory(hosts)
+        vmw.worker_processes = 2
+        parallel = vmw.hosts_to_inventory(hosts)
+        assert serial['all']['hosts'] == ['vm1', 'vm3']
+        assert serial['rhel7_64Guest']['hosts'] == ['vm1', 'vm3']
+        assert serial['_meta']['hostvars']['vm3']['ansible_host'] == '10.0.0.3'
+        assert parallel == serial
+
+    def test_retrieve_properties_pages_through_all_vms(self):
+        vmw = VMWareInventory(load=False)
+        vm1 = vim.VirtualMachine('vm-1')
+        vm2 = vim.VirtualMachine('vm-2')
+        def content(vm):
+            prop = FakeObject(name='config.changeVersion', val=vm._moId)
+            return FakeObject(obj=vm, propSet=[prop])
+        calls = []
+        def retrieve(specs, options):
+            calls.append((specs, options))
+            return FakeObject(objects=[content(vm1)], token='page2')
+        def cont(token):
+            calls.append(token)
+            return FakeObject(objects=[content(vm2)], token=None)
+        vmw.content = FakeObject(propertyCollector=FakeObject(
+            RetrievePropertiesEx=retrieve, ContinueRetrievePropertiesEx=cont))
+        props = vmw._retrieve_properties([vm1, vm2, FakeObject()], ['config.changeVersion'])
+        assert props == {'vm-1': {'config.changeVersion': 'vm-1'},
+                         'vm-2': {'config.changeVersion': 'vm-2'}}
+        specs, options = calls[0]
+        assert len(specs[0].objectSet) == 2
+        assert list(specs[0].propSet[0].pathSet) == ['config.changeVersion']
+        assert options.maxObjects == vmw.retrieve_page_size
+        assert calls[1:] == ['page2']
+
+    def test_retrieve_properties_asks_for_all_without_paths(self):
+        vmw = VMWareInventory(load=False)
+        calls = []
+        def retrieve(specs, options):
+            calls.append(specs)
+            return None
+        vmw.content = FakeObject(propertyCollector=FakeObject(RetrievePropertiesEx=retrieve))
+        assert vmw._retrieve_properties([vim.VirtualMachine('vm-1')]) == {}
+        assert calls[0][0].propSet[0].all
+
+    def test_versioned_facts_reused_for_unchanged_vm(self):
+        vmw, calls = bulk_inventory({'vm-1': live_vm_properties('v1')})
+        vmw.vm_facts = {'abc': {'changeversion': 'v1',
+                                'facts': {'config': {'name': 'stored'}}}}
+        inventory = vmw.instances_to_inventory([vim.VirtualMachine('vm-1')])
+        assert inventory['all']['hosts'] == ['stored']
+        hostvars = inventory['_meta']['hostvars']['stored']
+        assert hostvars['config'] == {'name': 'stored'}
+        assert hostvars['ansible_host'] == '10.0.0.1'
+        assert hostvars['custom_attributes'] == {'env': 'prod'}
+        # the unchanged vm is fetched with its volatile properties only
+        assert calls[-1] == vmw.volatile_keys
+        assert 'capability' not in hostvars
+        assert vmw.vm_facts['abc']['facts'] == {'config': {'name': 'stored'}}
+
+    def test_versioned_facts_rebuilt_for_changed_vm(self):
+        vmw, calls = bulk_inventory({'vm-1': live_vm_properties('v2')})
+        vmw.vm_facts = {'abc': {'changeversion': 'v1',
+                                'facts': {'config': {'name': 'stored'}}}}
+        inventory = vmw.instances_to_inventory([vim.VirtualMachine('vm-1')])
+        assert inventory['all']['hosts'] == ['live']
+        config = inventory['_meta']['hostvars']['live']['config']
+        config = dict((k,v) for k,v in config.items() if v is not None)
+        assert config == {'name': 'live', 'instanceuuid': 'abc', 'changeversion': 'v2'}
+        assert vmw.vm_facts['abc']['changeversion'] == 'v2'
+        stored = vmw.vm_facts['abc']['facts']
+        assert sorted(stored.keys()) == ['capability', 'config']
+        assert dict((k,v) for k,v in stored['config'].items() if v is not None) == config
+
+    def test_versioned_facts_pruned_for_missing_vm(self):
+        vmw, calls = bulk_inventory({'vm-1': live_vm_properties('v2')})
+        vmw.vm_facts = {'abc': {'changeversion': 'v1', 'facts': {}},
+                        'gone': {'changeversion': 'v1', 'facts': {}}}
+        vmw.instances_to_inventory([vim.VirtualMachine('vm-1')])
+        assert list(vmw.vm_facts.keys()) == ['abc']
+
+    def test_vm_facts_cache_ignored_when_settings_differ(self):
+        vmw = VMWareInventory(load=False)
+        vmw.args = FakeArgs()
+        vmw.maxlevel = 1
+        vmw.lowerkeys = True
+        fd, vmw.vm_facts_cache_path = tempfile.mkstemp()
+        os.close(fd)
+        vms = {'abc': {'changeversion': 'v1', 'facts': {}}}
+        try:
+            vmw.write_to_cache({'settings': vmw._vm_facts_settings(), 'vms': vms},
+                               vmw.vm_facts_cache_path)
+            assert vmw.get_vm_facts_from_cache() == vms
+            vmw.maxlevel = 2
+            assert vmw.get_vm_facts_from_cache() == {}
+        finally:
+            os.remove(vmw.vm_facts_cache_path)
 
 
 
@@ -36,8 +36,9 @@ import uuid
 
 from collections import defaultdict
 from pyVim.connect import SmartConnect, Disconnect
-from pyVmomi import vim
+from pyVmomi import vim, vmodl, VmomiSupport
 from six.moves import configparser
+from six.moves import cPickle
 from time import time
 
 
@@ -46,6 +47,13 @@ try:
 except ImportError:
     import simplejson as json
 
+hasfutures = False
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    hasfutures = True
+except ImportError:
+    pass
+
 hasvcr = False
 try:
     import vcr
@@ -54,6 +62,38 @@ except ImportError:
     pass
 
 
+def render_pattern(template, hostvars, dtype='string'):
+
+    ''' Render a compiled jinja template against a host's vars '''
+
+    newkey = template.render(hostvars)
+    newkey = newkey.strip()
+    if dtype == 'integer':
+        newkey = int(newkey)
+    elif dtype == 'boolean':
+        if newkey.lower() == 'false':
+            newkey = False
+        elif newkey.lower() == 'true':
+            newkey = True
+    elif dtype == 'string':
+        pass
+    return newkey
+
+
+def process_hosts(shard, settings):
+
+    ''' Normalize and template a pickled shard of hosts in a worker process '''
+
+    # module level so that it can be pickled into worker processes
+    vmw = VMWareInventory(load=False)
+    vmw.args = argparse.Namespace(debug=settings['debug'])
+    for k,v in settings.items():
+        setattr(vmw, k, v)
+    results = vmw._process_hosts(cPickle.loads(shard))
+    # the multiprocessing pickler is pure python, a string is cheap to pass
+    return cPickle.dumps(results, cPickle.HIGHEST_PROTOCOL)
+
+
 class VMWareInventory(object):
 
     __name__ = 'VMWareInventory'
@@ -73,11 +113,28 @@ class VMWareInventory(object):
     password = None
     host_filters = []
     groupby_patterns = []
+    custom_field_map = {}
+    content = None
+    alias_pattern = None
+    host_pattern = None
+    worker_processes = 1
+    retrieve_page_size = 500
+    vm_facts_cache_path = None
+    vm_facts = {}
 
     bad_types = ['Array']
     safe_types = [int, long, bool, str, float, None]
     iter_types = [dict, list]
+    plain_types = [type(None), bool, int, long, float, str, unicode, datetime.datetime]
     skip_keys = ['dynamicproperty', 'dynamictype', 'managedby', 'childtype']
+    # properties that change without config.changeVersion moving, these are
+    # fetched on every refresh while the others are reused from vm_facts
+    volatile_keys = ['name', 'overallStatus', 'configStatus', 'runtime', 'guest',
+                     'guestHeartbeatStatus', 'summary', 'storage', 'snapshot',
+                     'customValue']
+    # facts added to every host after normalization, never stored
+    generated_keys = ['custom_attributes', 'ansible_uuid', 'ansible_host',
+                      'ansible_ssh_host']
 
 
     def _empty_inventory(self):
@@ -137,15 +194,20 @@ class VMWareInventory(object):
 
         instances = self.get_instances()
 	self.instances = instances
+	self.vm_facts = self.get_vm_facts_from_cache()
 	self.inventory = self.instances_to_inventory(instances)
         self.write_to_cache(self.inventory, self.cache_path_cache)
+        if self.vm_facts_cache_path:
+            self.write_to_cache({'settings': self._vm_facts_settings(),
+                                 'vms': self.vm_facts},
+                                self.vm_facts_cache_path)
 
 
     def write_to_cache(self, data, cache_path):
 
         ''' Dump inventory to json file '''
 
-        with open(self.cache_path_cache, 'wb') as f:
+        with open(cache_path, 'wb') as f:
             f.write(json.dumps(data))
 
 
@@ -159,6 +221,31 @@ class VMWareInventory(object):
         return json.loads(jdata)
 
 
+    def _vm_facts_settings(self):
+
+        ''' Settings that change the shape of the stored per-vm facts '''
+
+        return {'max_object_level': self.maxlevel, 'lower_var_keys': self.lowerkeys}
+
+
+    def get_vm_facts_from_cache(self):
+
+        ''' Read in the per-vm facts keyed by instance uuid '''
+
+        if not self.vm_facts_cache_path or not os.path.isfile(self.vm_facts_cache_path):
+            return {}
+        try:
+            with open(self.vm_facts_cache_path, 'rb') as f:
+                jdata = json.loads(f.read())
+        except ValueError as e:
+            self.debugl("ignoring unreadable vm facts cache: %s" % e)
+            return {}
+        # facts serialized with other settings can not be reused
+        if jdata.get('settings') != self._vm_facts_settings():
+            return {}
+        return jdata.get('vms', {})
+
+
     def read_settings(self):
 
         ''' Reads the settings from the vmware_inventory.ini file '''
@@ -181,7 +268,9 @@ class VMWareInventory(object):
                         'host_pattern': '{{ guest.ipaddress }}',
                         'host_filters': '{{ guest.gueststate == "running" }}',
                         'groupby_patterns': '{{ guest.guestid }},{{ "templates" if config.template else "guests"}}',
-                        'lower_var_keys': True }
+                        'lower_var_keys': True,
+                        'worker_processes': 1,
+                        'cache_vm_facts': False }
 		   }
 
         if six.PY3:
@@ -224,6 +313,17 @@ class VMWareInventory(object):
             else:    
                 self.lowerkeys = False
 
+        self.vm_facts_cache_path = None
+        if str(config.get('vmware', 'cache_vm_facts')).lower() in ['yes', 'true', '1']:
+            self.vm_facts_cache_path = self.cache_dir + "/%s.facts" % cache_name
+
+        self.worker_processes = int(config.get('vmware', 'worker_processes'))
+        if self.worker_processes > 1 and not hasfutures:
+            self.debugl("concurrent.futures is unavailable, processing hosts serially")
+            self.worker_processes = 1
+
+        self.alias_pattern = config.get('vmware', 'alias_pattern')
+        self.host_pattern = config.get('vmware', 'host_pattern')
         self.host_filters = list(config.get('vmware', 'host_filters').split(','))
         self.groupby_patterns = list(config.get('vmware', 'groupby_patterns').split(','))
 
@@ -298,6 +398,8 @@ class VMWareInventory(object):
         atexit.register(Disconnect, si)
 
         content = si.RetrieveContent()
+        self.content = content
+        self.custom_field_map = self._get_custom_field_map(content)
         for child in content.rootFolder.childEntity:
             if hasattr(child, 'vmFolder'):
                 datacenter = child
@@ -331,6 +433,8 @@ class VMWareInventory(object):
         atexit.register(Disconnect, si)
 
         content = si.RetrieveContent()
+        self.content = content
+        self.custom_field_map = self._get_custom_field_map(content)
         for child in content.rootFolder.childEntity:
             if hasattr(child, 'vmFolder'):
                 datacenter = child
@@ -369,6 +473,8 @@ class VMWareInventory(object):
         #atexit.register(Disconnect, si)
 
         content = si.RetrieveContent()
+        self.content = content
+        self.custom_field_map = self._get_custom_field_map(content)
         for child in content.rootFolder.childEntity:
             if hasattr(child, 'vmFolder'):
                 datacenter = child
@@ -385,77 +491,285 @@ class VMWareInventory(object):
         return instances
 
 
+    def _get_custom_field_map(self, content):
+
+        ''' Map custom attribute keys to their names, once per refresh '''
+
+        field_map = {}
+        cfm = getattr(content, 'customFieldsManager', None)
+        if not cfm:
+            return field_map
+        for field in cfm.field:
+            field_map[field.key] = field.name
+        return field_map
+
+
+    def _get_custom_attributes(self, custom_values):
+
+        ''' Return a flat name:value dict from a VM's customValue list '''
+
+        attributes = {}
+        for cv in custom_values or []:
+            if isinstance(cv, dict):
+                key, value = cv.get('key'), cv.get('value')
+            else:
+                key, value = cv.key, cv.value
+            name = self.custom_field_map.get(key, str(key))
+            attributes[name] = value
+        return attributes
+
+
     def instances_to_inventory(self, instances):
 
         ''' Convert a list of vm objects into a json compliant inventory '''
 
-	inventory = self._empty_inventory()
-        inventory['all'] = {}
-        inventory['all']['hosts'] = []
-        last_idata = None
+        hosts = self._instances_to_hosts(instances)
+        return self.hosts_to_inventory(hosts)
+
+
+    def _instances_to_hosts(self, instances):
+
+        ''' Fetch all instances as (id, plain properties, facts, version) tuples '''
+
+        # facts stored for VMs whose change version has not moved
+        versions = self._get_change_versions(instances)
+        reused = {}
+        for moid, (iuuid, changeversion) in versions.iteritems():
+            stored = self.vm_facts.get(iuuid)
+            if stored and stored.get('changeversion') == changeversion:
+                reused[moid] = stored['facts']
+
+        # fetch the properties of all VMs in bulk
+        properties = {}
+        if self.content:
+            changed = [x for x in instances if getattr(x, '_moId', None) not in reused]
+            unchanged = [x for x in instances if getattr(x, '_moId', None) in reused]
+            properties.update(self._retrieve_properties(changed))
+            properties.update(self._retrieve_properties(
+                unchanged, self.volatile_keys))
+
+        hosts = []
         for instance in instances:
-    
+
             # make a unique id for this object to avoid vmware's
             # numerous uuid's which aren't all unique.
             thisid = str(uuid.uuid4())
 
-            # Get all known info about this instance
-            idata = {}
-            idata = self.facts_from_vobj(instance)
+            moid = getattr(instance, '_moId', None)
+            if moid in properties:
+                plain = self.plain_from_vobj(properties[moid])
+                hosts.append((thisid, plain, reused.get(moid, {}), versions.get(moid)))
+            else:
+                # not fetched in bulk, walk the object itself
+                hosts.append((thisid, None, self.facts_from_vobj(instance), None))
 
-            # Put it in the inventory
-            inventory['all']['hosts'].append(thisid)
-            inventory['_meta']['hostvars'][thisid] = idata.copy()
-            inventory['_meta']['hostvars'][thisid]['ansible_uuid'] = thisid
+        return hosts
 
-        # Make a map of the uuid to the name the user wants
-        name_mapping = self.create_template_mapping(inventory, 
-                            self.config.get('vmware', 'alias_pattern'))
 
-        host_mapping = self.create_template_mapping(inventory,
-                            self.config.get('vmware', 'host_pattern'))
+    def hosts_to_inventory(self, hosts):
 
-        # Reset the inventory keys
-        for k,v in name_mapping.iteritems():
+        ''' Normalize, template and group fetched hosts into an inventory '''
 
+        workers = self.worker_processes
+        if workers <= 1 or len(hosts) < workers:
+            results = self._process_hosts(hosts)
+        else:
+            # contiguous shards keep the merged results in host order
+            size = (len(hosts) + workers - 1) // workers
+            shards = [cPickle.dumps(hosts[i:i + size], cPickle.HIGHEST_PROTOCOL)
+                      for i in range(0, len(hosts), size)]
+            settings = self._worker_settings()
+            results = []
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for shard_results in executor.map(process_hosts, shards,
+                                                  [settings] * len(shards)):
+                    results.extend(cPickle.loads(shard_results))
+
+        if len(results) != len(hosts):
+            raise RuntimeError("processed %d of %d hosts" % (len(results), len(hosts)))
+
+        inventory = self._empty_inventory()
+        inventory['all'] = {}
+        inventory['all']['hosts'] = []
+        members = set()
+        vm_facts = {}
+        skip_keys = set(self.generated_keys)
+        for k in self.volatile_keys:
+            skip_keys.add(k.lower() if self.lowerkeys else k)
+        for host, result in zip(hosts, results):
+            version = host[3]
+            thisid, hostvars, alias, keep, groups = result
+
+            if version:
+                iuuid, changeversion = version
+                facts = {}
+                for k,v in hostvars.iteritems():
+                    if k not in skip_keys:
+                        facts[k] = v
+                vm_facts[iuuid] = {'changeversion': changeversion, 'facts': facts}
+
+            # Apply host filters
+            if not keep:
+                continue
+
+            # Put it in the inventory under the name the user wants
+            if alias not in inventory['_meta']['hostvars']:
+                inventory['all']['hosts'].append(alias)
+            inventory['_meta']['hostvars'][alias] = hostvars
+
+            # Create groups
+            for group in groups:
+                if group not in inventory:
+                    inventory[group] = {}
+                    inventory[group]['hosts'] = []
+                if (group, alias) not in members:
+                    members.add((group, alias))
+                    inventory[group]['hosts'].append(alias)
+
+        # keep only the vms that still exist
+        self.vm_facts = vm_facts
+
+        return inventory
+
+
+    def _worker_settings(self):
+
+        ''' Attributes a worker process needs to normalize and template hosts '''
+
+        args = getattr(self, 'args', None)
+        return {'debug': bool(getattr(args, 'debug', False)),
+                'maxlevel': self.maxlevel,
+                'lowerkeys': self.lowerkeys,
+                'custom_field_map': self.custom_field_map,
+                'alias_pattern': self.alias_pattern,
+                'host_pattern': self.host_pattern,
+                'host_filters': self.host_filters,
+                'groupby_patterns': self.groupby_patterns}
+
+
+    def _process_hosts(self, hosts):
+
+        ''' Return (id, hostvars, alias, keep, groups) for each fetched host '''
+
+        alias_t = jinja2.Template(self.alias_pattern)
+        host_t = jinja2.Template(self.host_pattern)
+        filter_ts = [jinja2.Template(x) for x in self.host_filters if x]
+        groupby_ts = [jinja2.Template(x) for x in self.groupby_patterns]
+
+        results = []
+        for thisid, properties, facts, version in hosts:
+
+            hostvars = {}
+            if properties is not None:
+                hostvars = self.facts_from_vobj(properties)
+            hostvars.update(facts)
+            hostvars['ansible_uuid'] = thisid
+
+            alias = render_pattern(alias_t, hostvars)
+            host = render_pattern(host_t, hostvars)
             # set ansible_host (2.x)
-            inventory['_meta']['hostvars'][k]['ansible_host'] = host_mapping[k]
+            hostvars['ansible_host'] = host
             # 1.9.x backwards compliance
-            inventory['_meta']['hostvars'][k]['ansible_ssh_host'] = host_mapping[k]
+            hostvars['ansible_ssh_host'] = host
 
-            if k == v:
-                continue
+            keep = True
+            for t in filter_ts:
+                if not render_pattern(t, hostvars, dtype='boolean'):
+                    keep = False
+                    break
 
-            # add new key
-            inventory['all']['hosts'].append(v)
-            inventory['_meta']['hostvars'][v] = inventory['_meta']['hostvars'][k]
+            groups = []
+            if keep:
+                groups = [render_pattern(t, hostvars) for t in groupby_ts]
 
-            # cleanup old key
-            inventory['all']['hosts'].remove(k)
-            inventory['_meta']['hostvars'].pop(k, None)
+            results.append((thisid, hostvars, alias, keep, groups))
+        return results
 
-        # Apply host filters
-        for hf in self.host_filters:
-            if not hf:
-                continue
-            filter_map = self.create_template_mapping(inventory, hf, dtype='boolean')
-            for k,v in filter_map.iteritems():
-                if not v:
-                    # delete this host
-                    inventory['all']['hosts'].remove(k)
-                    inventory['_meta']['hostvars'].pop(k, None)
-
-        # Create groups
-        for gbp in self.groupby_patterns:
-            groupby_map = self.create_template_mapping(inventory, gbp)
-            for k,v in groupby_map.iteritems():
-                if v not in inventory:
-                    inventory[v] = {}
-                    inventory[v]['hosts'] = []
-                if k not in inventory[v]['hosts']:
-                    inventory[v]['hosts'].append(k)    
-
-	return inventory
+
+    def plain_from_vobj(self, vobj, level=0):
+
+        ''' Convert fetched pyvmomi data into plain, picklable python data '''
+
+        # most values are already plain, check for them first
+        if type(vobj) in self.plain_types:
+            return vobj
+        # level follows facts_from_vobj, nothing it would drop is converted
+        if isinstance(vobj, VmomiSupport.DataObject):
+            if level + 1 > self.maxlevel:
+                return None
+            rdata = {}
+            for k,v in vobj.__dict__.iteritems():
+                rdata[k] = self.plain_from_vobj(v, level=level + 1)
+            return rdata
+        if isinstance(vobj, list):
+            return [self.plain_from_vobj(x, level=level) for x in vobj]
+        if isinstance(vobj, VmomiSupport.ManagedObject):
+            # references to other managed objects are not followed
+            return None
+        if isinstance(vobj, dict):
+            # the property set of one VM
+            rdata = dict((k, self.plain_from_vobj(v, level=level))
+                         for k,v in vobj.iteritems())
+            # custom_attributes are resolved from customValue at any level
+            if vobj.get('customValue'):
+                rdata['customValue'] = [{'key': cv.key, 'value': cv.value}
+                                        for cv in vobj['customValue']]
+            return rdata
+        # enums and sized integers are subclasses of the builtin types
+        if isinstance(vobj, bool):
+            return bool(vobj)
+        for btype in [str, unicode, long, int, float]:
+            if isinstance(vobj, btype):
+                return btype(vobj)
+        self.debugl("unknown datatype: %s" % type(vobj))
+        return None
+
+
+    def _retrieve_properties(self, objects, path_set=None):
+
+        ''' Fetch properties of many VMs with paged PropertyCollector calls '''
+
+        vms = [x for x in objects if isinstance(x, vim.VirtualMachine)]
+        if not vms:
+            return {}
+
+        # without a path set the server returns every property it knows,
+        # so older vCenters are never asked for paths they can not resolve
+        PC = vmodl.query.PropertyCollector
+        if path_set:
+            prop_spec = PC.PropertySpec(type=vim.VirtualMachine, pathSet=path_set)
+        else:
+            prop_spec = PC.PropertySpec(type=vim.VirtualMachine, all=True)
+        filter_spec = PC.FilterSpec(
+            objectSet=[PC.ObjectSpec(obj=x) for x in vms],
+            propSet=[prop_spec])
+        options = PC.RetrieveOptions(maxObjects=self.retrieve_page_size)
+
+        pc = self.content.propertyCollector
+        properties = {}
+        result = pc.RetrievePropertiesEx([filter_spec], options)
+        while result:
+            for oc in result.objects:
+                properties[oc.obj._moId] = dict((p.name, p.val) for p in oc.propSet)
+            if not result.token:
+                break
+            result = pc.ContinueRetrievePropertiesEx(result.token)
+        return properties
+
+
+    def _get_change_versions(self, instances):
+
+        ''' Return a map of moid to (instance uuid, change version) for all VMs '''
+
+        versions = {}
+        if not self.vm_facts_cache_path or not self.content:
+            return versions
+
+        paths = ['config.instanceUuid', 'config.changeVersion']
+        for moid, props in self._retrieve_properties(instances, paths).iteritems():
+            if paths[0] in props and paths[1] in props:
+                versions[moid] = (props[paths[0]], props[paths[1]])
+        return versions
 
 
     def create_template_mapping(self, inventory, pattern, dtype='string'):
@@ -463,20 +777,9 @@ class VMWareInventory(object):
         ''' Return a hash of uuid to templated string from pattern '''
 
         mapping = {}
+        t = jinja2.Template(pattern)
         for k,v in inventory['_meta']['hostvars'].iteritems():
-            t = jinja2.Template(pattern)
-            newkey = t.render(v)
-            newkey = newkey.strip()
-            if dtype == 'integer':
-                newkey = int(newkey)
-            elif dtype == 'boolean':
-                if newkey.lower() == 'false':
-                    newkey = False
-                elif newkey.lower() == 'true':
-                    newkey = True    
-            elif dtype == 'string':
-                pass        
-            mapping[k] = newkey
+            mapping[k] = render_pattern(t, v, dtype=dtype)
         return mapping
 
 
@@ -488,6 +791,7 @@ class VMWareInventory(object):
         # https://github.com/vmware/pyvmomi/issues/21
 
         rdata = {}
+        custom_values = None
 
 	# Do not serialize self
         if hasattr(vobj, '__name__'):
@@ -498,10 +802,15 @@ class VMWareInventory(object):
         if level > self.maxlevel:
             return rdata
 
+        # Plain data from plain_from_vobj is a dict
+        if isinstance(vobj, dict):
+            custom_values = vobj.get('customValue')
+
         # Objects usually have a dict property
-        if hasattr(vobj, '__dict__') and not level == 0:
+        if isinstance(vobj, dict) or (hasattr(vobj, '__dict__') and not level == 0):
 
-            for k,v in vobj.__dict__.iteritems():
+            vdict = vobj if isinstance(vobj, dict) else vobj.__dict__
+            for k,v in vdict.iteritems():
 
                 # Skip private methods
                 if k.startswith('_'):
@@ -536,10 +845,19 @@ class VMWareInventory(object):
                 if callable(methodToCall):
                     continue
 
+                # keep the fetched value, it is not serialized at level 0
+                if method == 'customValue':
+                    custom_values = methodToCall
+
                 if self.lowerkeys:
                     method = method.lower()
 
 		rdata[method] = self._process_object_types(methodToCall, level=level)
+
+        # Resolve custom attribute keys to names for easy grouping
+        if level == 0:
+            rdata['custom_attributes'] = self._get_custom_attributes(custom_values)
+
         return rdata
 
 
@@ -573,7 +891,7 @@ class VMWareInventory(object):
 			if vid:
 			    rdata.append(vid)
 
-        elif hasattr(vobj, '__dict__'):
+        elif isinstance(vobj, dict) or hasattr(vobj, '__dict__'):
 	    if (level+1 <= self.maxlevel):
 		md = None
 		md = self.facts_from_vobj(vobj, level=(level+1))